@@ -13,22 +13,87 @@
 # You should have received a copy of the GNU General Public License
 # along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Script run ensure_dependencies.get_deps() externally."""
+"""Read a dependencies file, as done by ensure_dependencies.read_deps()."""
 
-from __future__ import print_function
+from __future__ import unicode_literals
 
-import json
+import io
+import logging
 import os
-import sys
+import re
 
+logger = logging.getLogger('dependencies')
 
-def dep_as_json():
-    """Read configured dependencies via ensure_dependencies.get_deps()."""
-    cwd = os.getcwd()
-    sys.path.append(cwd)
-    import ensure_dependencies
-    return json.dumps(ensure_dependencies.read_deps(cwd), indent=4)
+ITEM_REGEX = re.compile(r'^(?:(\w+):)?(.+)$')
+COMMENT_REGEX = re.compile(r'#.*')
 
 
-if __name__ == '__main__':
-    print(dep_as_json())
+def _merge_seqs(seq1, seq2):
+    """Return any truthy values of seq2, falling back to those of seq1.
+
+    (None, '2'), ('1', None) => ('1', '2')
+    None, ('1', '2')         => ('1', '2')
+    ('1', '2'), ('3', '4')   => ('3', '4')
+    """
+    return tuple(item2 or item1
+                 for item1, item2 in zip(seq1 or (None,) * len(seq2), seq2))
+
+
+def _parse_spec(path, line):
+    if '=' not in line:
+        logger.warning('Invalid line in file {}: {}'.format(path, line))
+        return None, None
+
+    key, value = line.split('=', 1)
+    key = key.strip()
+    items = value.split()
+    if len(items) == 0:
+        logger.warning('No value specified for key {} in file {}'.format(
+            key, path))
+        return key, None
+
+    result = {}
+    is_dependency_field = not key.startswith('_')
+
+    for i, item in enumerate(items):
+        vcs, value = ITEM_REGEX.search(item).groups()
+        vcs = vcs or '*'
+        if not is_dependency_field:
+            result[vcs] = value
+        elif i == 0 and vcs == '*':
+            # For backwards compatibility, the first source only holds the
+            # target path.
+            result[vcs] = (value, None)
+        else:
+            # Repeated items for the same VCS complement each other, e.g. a
+            # bare revision following the target path.
+            source, _, revision = value.rpartition('@')
+            result[vcs] = _merge_seqs(result.get(vcs), (source, revision))
+
+    return key, result
+
+
+def read_deps(repodir):
+    """Parse the dependencies file of the given repository.
+
+    The result matches the structure returned by buildtools'
+    ensure_dependencies.read_deps(), which is only compatible with python2.
+    Returns None, if there is no dependencies file.
+
+    """
+    deps_path = os.path.join(repodir, 'dependencies')
+    if not os.path.exists(deps_path):
+        return None
+
+    result = {}
+    with io.open(deps_path, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            # Remove comments and whitespace
+            line = COMMENT_REGEX.sub('', line).strip()
+            if not line:
+                continue
+
+            key, spec = _parse_spec(deps_path, line)
+            if spec:
+                result[key] = spec
+    return result
@@ -25,24 +25,65 @@ diff of imported changes, as well as related integration notes.
 from __future__ import print_function, unicode_literals
 
 import argparse
+import errno
+import functools
 import io
-import json
 import logging
+import operator
 import os
 import re
+import socket
 import subprocess
+import sys
+import threading
 try:
-    from urllib import urlopen
+    from os import replace as replace_file
 except ImportError:
-    from urllib.request import urlopen
-
-import jinja2
+    from os import rename as replace_file
+try:
+    from httplib import BadStatusLine, HTTPSConnection
+except ImportError:
+    from http.client import BadStatusLine, HTTPSConnection
+try:
+    from urlparse import urljoin, urlsplit
+except ImportError:
+    from urllib.parse import urljoin, urlsplit
+try:
+    # Optionally match commit messages and ticket pages with a linear-time
+    # regular expression engine, if it is installed.
+    import re2 as re_engine
+except ImportError:
+    re_engine = re
 
+from src.dependencies import read_deps
 from src.vcs import Vcs
 
 logging.basicConfig()
 logger = logging.getLogger('depup')
 
+DEFAULT_TEMPLATE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'templates', 'default.trac')
+
+_jinja_environments = {}
+
+
+def _jinja_environment(path):
+    """Provide a cached jinja2 Environment, loading templates from path.
+
+    Compiled templates are additionally kept in a bytecode cache, which is
+    shared between runs.
+    """
+    if path not in _jinja_environments:
+        # jinja2 is only imported when needed, since it is slow to import
+        import jinja2
+
+        _jinja_environments[path] = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(path),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(),
+            auto_reload=False,
+        )
+    return _jinja_environments[path]
+
 
 class DepUpdate(object):
     """The main class used to process dependency updates.
@@ -53,15 +94,28 @@ class DepUpdate(object):
 
     VCS_EXECUTABLE = ('hg', '--config', 'defaults.log=', '--config',
                       'defaults.pull=')
-    ISSUE_NUMBER_REGEX = re.compile(r'\b(issue|fixes)\s+(\d+)\b', re.I)
-    NOISSUE_REGEX = re.compile(r'^noissue\b', re.I)
+    # Matches any commit message, telling apart a leading "noissue" and the
+    # first referenced issue number in a single pass.
+    ISSUE_REFERENCE_REGEX = re_engine.compile(
+        r'(?is)^(?P<noissue>noissue\b)?'
+        r'(?:.*?\b(?:issue|fixes)\s+(?P<issue_id>\d+)\b)?')
+    # Ticket pages are searched as they are received, without decoding
+    INTEGRATION_NOTES_REGEX = re_engine.compile(br'(?i)Integration\s*notes')
+    ISSUE_TRACKER_HOST = 'issues.adblockplus.org'
+    MAX_PARALLEL_REQUESTS = 16
+    MAX_REDIRECTS = 3
+    REQUEST_TIMEOUT = 10
+
+    # Shared by all instances, see DepUpdate._make_parser()
+    _argument_parser = None
 
     def __init__(self, *args):
         """Construct a DepUpdate object.
 
-        During initialization, DepUpdate will invoke the appropriate VCS to
-        fetch a list of changes, parse them and (if not otherwise specified)
-        get the matching revisions from the mirrored repository.
+        During initialization, DepUpdate will only determine the appropriate
+        VCS. Fetching and parsing the list of changes, as well as getting the
+        matching revisions from the mirrored repository (if not otherwise
+        specified), is deferred until the results are actually needed.
 
         Parameters: *args - Passed down to the argparse.ArgumentParser instance
 
@@ -71,46 +125,46 @@ class DepUpdate(object):
         self.root_repo = Vcs.factory(self._cwd)
 
         self._base_revision = None
+        self._change_list = None
+        self._changes = None
         self._parsed_changes = None
+        self._issue_ids = None
         self.arguments = None
 
         self._dep_config = None
 
-        default_template = os.path.join(
-            os.path.dirname(os.path.realpath(__file__)), 'templates',
-            'default.trac')
-
         # Initialize and run the internal argument parser
-        self._make_arguments(default_template, *args)
+        self._make_arguments(*args)
 
         # Check if root repository is dirty
         if not self.root_repo.repo_is_clean():
             logger.error('Your repository is dirty')
             exit(1)
 
-        # Initialize the main VCS and the list of changes
+        # Initialize the main VCS. Any list of changes is only fetched on
+        # demand, see DepUpdate.changes
         self._main_vcs = Vcs.factory(os.path.join(self._cwd,
                                      self.arguments.dependency))
-        self.changes = self._main_vcs.change_list(self.base_revision,
-                                                  self.arguments.new_revision)
-        if len(self.changes) == 0:
-            self.changes = self._main_vcs.change_list(
-                    self.arguments.new_revision,
-                    self.base_revision
-            )
-            if len(self.changes) > 0:
-                # reverse mode. Uh-oh.
-                logger.warn('You are trying to downgrade the dependency!')
-
-        self._main_vcs.enhance_changes_information(
-            self.changes,
-            os.path.join(self._mirror_location(),
-                         self.arguments.dependency),
-            self.arguments.skip_mirror,
-        )
+        # A commit must not record an outdated revision, only because the
+        # dependency was pulled / fetched less than a minute ago.
+        if self.arguments.action == 'commit':
+            self._main_vcs.throttle_updates = False
+
+    def __enter__(self):
+        """Enter the object's context."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Exit the object's context and stop any shared VCS processes."""
+        self.root_repo.close()
+        self._main_vcs.close()
+
+    @classmethod
+    def _make_parser(cls):
+        """Provide the argument parser, which is only built once."""
+        if cls._argument_parser is not None:
+            return cls._argument_parser
 
-    def _make_arguments(self, default_template, *args):
-        """Initialize the argument parser and store the arguments."""
         parser = argparse.ArgumentParser(
             description=__doc__,
             formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -186,7 +240,7 @@ class DepUpdate(object):
                              'according to the given template.'))
         issue_parser.add_argument(
                 '-t', '--template', dest='tmpl_path',
-                default=default_template,
+                default=DEFAULT_TEMPLATE,
                 help=('The template to use. Defaults to the provided '
                       'default.trac (Used only with -i/--issue).')
         )
@@ -212,115 +266,182 @@ class DepUpdate(object):
         commit_parser.set_defaults(skip_mirror=False, lookup_inotes=False,
                                    filename=None)
 
-        self.arguments = parser.parse_args(args if len(args) > 0 else None)
+        cls._argument_parser = parser
+        return parser
+
+    def _make_arguments(self, *args):
+        """Parse and store the arguments."""
+        self.arguments = self._make_parser().parse_args(
+                args if len(args) > 0 else None)
 
     @property
     def dep_config(self):
-        """Provide the dependencies by using ensure_dependencies.read_dep().
+        """Provide the dependencies as ensure_dependencies.read_deps() does.
 
         Since this program is meant to be run inside a repository which uses
-        the buildtools' dependency functionalities, we are sure that
-        ensure_dependencies.py and dependencies exist.
+        the buildtools' dependency functionalities, we are sure that a
+        dependencies file exists.
 
         However, ensure_dependencies is currently only compatible with python2.
-        Due to this we explicitly invoke a python2 interpreter to run our
-        dependencies.py, which runs ensure_dependencies.read_deps() and returns
-        the output as JSON data.
+        Due to this we parse the dependencies file ourselves, in the same way
+        ensure_dependencies.read_deps() does.
         """
         if self._dep_config is None:
-            dependencies_script = os.path.join(
-                os.path.dirname(os.path.realpath(__file__)), 'dependencies.py')
-
-            dep_json = subprocess.check_output(
-                ['python2', dependencies_script]
-            ).decode('utf-8')
-            self._dep_config = json.loads(dep_json)
+            self._dep_config = read_deps(self._cwd)
         return self._dep_config
 
     @property
     def base_revision(self):
         """Provide the current revision of the dependency to be processed."""
         if self._base_revision is None:
+            config = self.dep_config[self.arguments.dependency]
             for key in ['*', self._main_vcs.EXECUTABLE]:
-                rev = self.dep_config[self.arguments.dependency][key][1]
+                rev = config[key][1]
                 if rev is not None:
                     self._base_revision = rev
                     break
         return self._base_revision
 
+    def _get_change_list(self):
+        """Fetch the plain list of changes from the dependency's VCS."""
+        if self._change_list is None:
+            self._change_list, downgrade = (
+                    self._main_vcs.directed_change_list(
+                        self.base_revision,
+                        self.arguments.new_revision
+                    ))
+            if downgrade and len(self._change_list) > 0:
+                # reverse mode. Uh-oh.
+                logger.warn('You are trying to downgrade the dependency!')
+        return self._change_list
+
+    @property
+    def changes(self):
+        """Provide the list of changes, including the mirrored revisions.
+
+        Each change is a dictionary, containing the keys "author", "date",
+        "message", "hg_hash", "hg_url", "git_hash" and "git_url".
+        """
+        if self._changes is None:
+            self._changes = self._get_change_list()
+            self._main_vcs.enhance_changes_information(
+                self._changes,
+                os.path.join(self._mirror_location(),
+                             self.arguments.dependency),
+                self.arguments.skip_mirror,
+            )
+        return self._changes
+
+    def _match_reference(self, message):
+        """Return the issue ID and whether "noissue" is referenced."""
+        # Without any of the keywords, neither an issue nor "noissue" can be
+        # referenced, so most messages can skip the regular expression.
+        lowered = message.lower()
+        if 'issue' not in lowered and 'fixes' not in lowered:
+            return None, False
+
+        match = self.ISSUE_REFERENCE_REGEX.match(message)
+        return match.group('issue_id'), bool(match.group('noissue'))
+
+    @staticmethod
+    def _sorted_issue_ids(issue_ids):
+        # Keep the rendered output stable, independent of the set's order
+        return tuple(sorted(issue_ids, key=int))
+
+    def _extract_issue_ids(self, changes):
+        """Collect the referenced issue IDs, in ascending order."""
+        issue_ids = set()
+        for change in changes:
+            issue_id, _ = self._match_reference(change['message'])
+            if issue_id:
+                issue_ids.add(issue_id)
+        return self._sorted_issue_ids(issue_ids)
+
     def _parse_changes(self, changes):
         """Parse the changelist to issues / noissues."""
         issue_ids = set()
         noissues = []
+        warnings = []
+        warning_fields = operator.itemgetter('message', 'hg_hash', 'git_hash')
         for change in changes:
-            match = self.ISSUE_NUMBER_REGEX.search(change['message'])
-            if match:
-                issue_ids.add(match.group(2))
+            issue_id, noissue = self._match_reference(change['message'])
+            if issue_id:
+                issue_ids.add(issue_id)
             else:
                 noissues.append(change)
-                if not self.NOISSUE_REGEX.search(change['message']):
-                    msg = (
-                        'warning: no issue reference in commit message: '
-                        '"{message}" (commit {hg_hash} | {git_hash})\n'
-                    ).format(**change)
-                    logger.warn(msg)
+                if not noissue:
+                    warnings.append(warning_fields(change))
+
+        # Report all unreferenced changes at once, unless warnings are not
+        # shown anyway.
+        if len(warnings) > 0 and logger.isEnabledFor(logging.WARNING):
+            logger.warn(''.join(
+                'warning: no issue reference in commit message: "%s" '
+                '(commit %s | %s)\n' % fields
+                for fields in warnings
+            ))
 
-        return issue_ids, noissues
+        return self._sorted_issue_ids(issue_ids), tuple(noissues)
 
     @property
     def parsed_changes(self):
         """Provide the list of changes, separated by issues and noissues.
 
         Returns a dictionary, containing the following two key/value pairs:
-        'issue_ids': a list of issue IDs (as seen on
-                     https://issues.adblockplus.org/)
-        'noissues': The remaining changes, with all original information (see
-                    DepUpdate.changes) which could not be associated with any
-                    issue.
+        'issue_ids': a tuple of issue IDs (as seen on
+                     https://issues.adblockplus.org/), in ascending order
+        'noissues': A tuple of the remaining changes, with all original
+                    information (see DepUpdate.changes) which could not be
+                    associated with any issue.
         """
         if self._parsed_changes is None:
-            self._parsed_changes = {}
+            # Only publish the complete result, since the integration notes
+            # lookup might read it from another thread.
             issue_ids, noissues = self._parse_changes(self.changes)
-            self._parsed_changes['issue_ids'] = issue_ids
-            self._parsed_changes['noissues'] = noissues
+            self._parsed_changes = {'issue_ids': issue_ids,
+                                    'noissues': noissues}
         return self._parsed_changes
 
+    @property
+    def issue_ids(self):
+        """Provide the referenced issue IDs, in ascending order.
+
+        Other than DepUpdate.parsed_changes, this neither needs the mirrored
+        revisions, nor warns about changes without an issue reference.
+        """
+        if self._parsed_changes is not None:
+            return self._parsed_changes['issue_ids']
+        if self._issue_ids is None:
+            self._issue_ids = self._extract_issue_ids(self._get_change_list())
+        return self._issue_ids
+
     def _possible_sources(self):
-        root_conf = self._dep_config['_root']
+        root_conf = self.dep_config['_root']
         config = self.dep_config[self.arguments.dependency]
 
-        # The fallback / main source paths for a repository are given in the
-        # dependencies file's _root section.
-        keys = ['hg', 'git']
         possible_sources = {}
-        possible_sources.update({
-            key + '_root': root_conf[key]
-            for key in keys
-        })
-
-        # Any dependency may specify a custom source location.
-        possible_sources.update({
-            key: source for key, source in [
-                (key, config.get(key, (None, None))[0]) for key in keys
-            ] if source is not None
-        })
+        for key in ['hg', 'git']:
+            # The fallback / main source paths for a repository are given in
+            # the dependencies file's _root section.
+            possible_sources[key + '_root'] = root_conf[key]
+
+            # Any dependency may specify a custom source location.
+            source = config.get(key, (None, None))[0]
+            if source is not None:
+                possible_sources[key] = source
 
         return possible_sources
 
     def _mirror_location(self):
-        possible_sources = self._possible_sources()
-        mirror_ex = self._main_vcs._other_cls.EXECUTABLE
-
         # If the user specified a local mirror, use it. Otherwise use the
         # mirror, which was specified in the dependencies file.
         if self.arguments.local_mirror:
-            mirror = self.arguments.local_mirror
-        else:
-            for key in [mirror_ex, mirror_ex + '_root']:
-                if key in possible_sources:
-                    mirror = possible_sources[key]
-                    break
-        return mirror
+            return self.arguments.local_mirror
+
+        possible_sources = self._possible_sources()
+        mirror_ex = self._main_vcs._other_cls.EXECUTABLE
+        return (possible_sources.get(mirror_ex) or
+                possible_sources.get(mirror_ex + '_root'))
 
     def _make_dependencies_string(self, hg_source=None, hg_rev=None,
                                   git_source=None, git_rev=None,
@@ -339,26 +460,46 @@ class DepUpdate(object):
         return dependency
 
     def _update_dependencies_file(self):
-        config = self.dep_config[self.arguments.dependency]
+        dependency = self.arguments.dependency
+        config = self.dep_config[dependency]
 
-        remote_repository_name, none_hash_rev = config.get('*', (None, None))
-        hg_source, hg_rev = config.get('hg', (None, None))
-        git_source, git_rev = config.get('git', (None, None))
-
-        current_entry = self._make_dependencies_string(
-            hg_source, hg_rev, git_source, git_rev, remote_repository_name
-        )
+        remote_repository_name = config.get('*', (None, None))[0]
+        hg_source = config.get('hg', (None, None))[0]
+        git_source = config.get('git', (None, None))[0]
 
+        latest = self.changes[0]
         new_entry = self._make_dependencies_string(
-            hg_source, self.changes[0]['hg_hash'], git_source,
-            self.changes[0]['git_hash'], remote_repository_name
+            hg_source, latest['hg_hash'], git_source, latest['git_hash'],
+            remote_repository_name
         )
 
+        # Only rewrite the dependency's own entry, regardless of its
+        # whitespace and keeping any comment.
+        entry_regex = re.compile(r'^\s*' + re.escape(dependency) +
+                                 r'\s*=.*?(?=\s*(?:#|$))')
         dependency_path = os.path.join(self._cwd, 'dependencies')
         with io.open(dependency_path, 'r', encoding='utf-8') as fp:
-            current_deps = fp.read()
-        with io.open(dependency_path, 'w', encoding='utf-8') as fp:
-            fp.write(current_deps.replace(current_entry, new_entry))
+            lines = fp.readlines()
+
+        for i, line in enumerate(lines):
+            lines[i], replaced = entry_regex.subn(lambda match: new_entry,
+                                                  line, count=1)
+            if replaced:
+                break
+        else:
+            logger.error('No entry for {} found in {}'.format(
+                dependency, dependency_path))
+            sys.exit(1)
+
+        # Leave the file untouched, if it already points to the new revision
+        if lines[i] == line:
+            return
+
+        # Atomically replace the dependencies file
+        temporary_path = dependency_path + '.tmp'
+        with io.open(temporary_path, 'w', encoding='utf-8') as fp:
+            fp.writelines(lines)
+        replace_file(temporary_path, dependency_path)
 
     def _update_copied_code(self):
         subprocess.check_output(
@@ -366,69 +507,157 @@ class DepUpdate(object):
             cwd=self._cwd
         )
 
-    def build_diff(self):
-        """Generate a unified diff of all changes."""
+    def build_diff(self, out_fp=None):
+        """Generate a unified diff of all changes.
+
+        When out_fp is given, the diff is streamed to this binary file object,
+        instead of being returned.
+        """
         return self._main_vcs.merged_diff(self.base_revision,
                                           self.arguments.new_revision,
-                                          self.arguments.unified_lines)
+                                          self.arguments.unified_lines,
+                                          out_fp)
 
     def build_issue(self):
         """Process all changes and render an issue."""
+        parsed_changes = self.parsed_changes
+        latest = self.changes[0]
+
         context = {}
         context['repository'] = self.arguments.dependency
-        context['issue_ids'] = self.parsed_changes['issue_ids']
-        context['noissues'] = self.parsed_changes['noissues']
-        context['hg_hash'] = self.changes[0]['hg_hash']
-        context['git_hash'] = self.changes[0]['git_hash']
+        context['issue_ids'] = parsed_changes['issue_ids']
+        context['noissues'] = parsed_changes['noissues']
+        context['hg_hash'] = latest['hg_hash']
+        context['git_hash'] = latest['git_hash']
         context['raw_changes'] = self.changes
 
         path, filename = os.path.split(self.arguments.tmpl_path)
 
-        return jinja2.Environment(
-            loader=jinja2.FileSystemLoader(path or './')
-        ).get_template(filename).render(context)
+        return _jinja_environment(path or './').get_template(
+            filename).render(context)
+
+    def _get_response(self, connection, path):
+        """Request path, retrying once if the connection was closed."""
+        try:
+            connection.request('GET', path)
+            return connection.getresponse()
+        except (BadStatusLine, socket.error) as e:
+            # The issue tracker might have closed an idle connection, retry
+            # once with a new one. Other errors, like timeouts, would only
+            # occur again.
+            if not isinstance(e, BadStatusLine) and \
+                    e.errno not in (errno.ECONNRESET, errno.EPIPE):
+                raise
+            connection.close()
+            connection.request('GET', path)
+            return connection.getresponse()
+
+    def _integration_notes_url(self, connections, issue_id):
+        """Return the issue's URL, if it mentions integration notes.
+
+        Parameters: connections - A dictionary, holding each thread's
+                                  connection to the issue tracker, which is
+                                  reused for subsequent issues
+                    issue_id - The issue to look at
+
+        """
+        thread_id = threading.current_thread().ident
+        if thread_id not in connections:
+            connections[thread_id] = HTTPSConnection(
+                self.ISSUE_TRACKER_HOST, timeout=self.REQUEST_TIMEOUT)
+
+        host, path = self.ISSUE_TRACKER_HOST, '/ticket/' + issue_id
+        for _ in range(self.MAX_REDIRECTS + 1):
+            if host == self.ISSUE_TRACKER_HOST:
+                connection = connections[thread_id]
+            else:
+                connection = HTTPSConnection(host,
+                                             timeout=self.REQUEST_TIMEOUT)
+            try:
+                response = self._get_response(connection, path)
+                # A response needs to be read completely, before the
+                # connection can be reused.
+                content = response.read()
+            finally:
+                if connection is not connections[thread_id]:
+                    connection.close()
+
+            if response.status not in (301, 302, 303, 307, 308):
+                break
+            location = urlsplit(urljoin('https://' + host + path,
+                                        response.getheader('Location', '')))
+            host = location.netloc
+            path = location.path + ('?' + location.query
+                                    if location.query else '')
+
+        if response.status != 200:
+            logger.warn('warning: could not look up issue %s: %d %s',
+                        issue_id, response.status, response.reason)
+            return None
+        if self.INTEGRATION_NOTES_REGEX.search(content):
+            return 'https://' + host + path
+        return None
 
     def lookup_integration_notes(self):
         """Search for any "Integration notes" mentions at the issue-tracker.
 
         Cycle through the list of issue IDs and search for "Integration Notes"
         in the associated issue on https://issues.adblockplus.org. If found,
-        write the corresponding url to STDERR.
+        write the corresponding url to STDERR. The issues are requested in
+        parallel, using up to DepUpdate.MAX_PARALLEL_REQUESTS connections,
+        which are kept open until all issues are processed.
         """
+        from multiprocessing.pool import ThreadPool
+
         # Let logger show INFO-level messages
         logger.setLevel(logging.INFO)
-        integration_notes_regex = re.compile(r'Integration\s*notes', re.I)
 
-        def from_url(issue_url):
-            html = ''
-            content = urlopen(issue_url)
-
-            for line in content:
-                html += line.decode('utf-8')
-            return html
+        issue_ids = self.issue_ids
+        if len(issue_ids) == 0:
+            return
 
-        for issue_id in self.parsed_changes['issue_ids']:
-            issue_url = 'https://issues.adblockplus.org/ticket/' + issue_id
-            html = from_url(issue_url)
-            if not integration_notes_regex.search(html):
-                continue
+        connections = {}
 
-            logger.info('Integration notes found: ' + issue_url)
+        pool = ThreadPool(min(self.MAX_PARALLEL_REQUESTS, len(issue_ids)))
+        try:
+            for issue_url in pool.imap(
+                    functools.partial(self._integration_notes_url,
+                                      connections),
+                    issue_ids):
+                if issue_url is not None:
+                    logger.info('Integration notes found: ' + issue_url)
+        finally:
+            pool.close()
+            pool.join()
+            for connection in connections.values():
+                connection.close()
+
+    def _try_lookup_integration_notes(self):
+        """Run the integration notes lookup, without letting it fail the run.
+
+        The lookup is only informational, so e.g. an unreachable issue tracker
+        is reported, rather than discarding the requested action's output.
+        """
+        try:
+            self.lookup_integration_notes()
+        except Exception as e:
+            logger.error('Could not look up integration notes: %s', e)
 
     def build_changes(self):
         """Write a descriptive list of the changes to STDOUT."""
+        fields = operator.itemgetter('hg_hash', 'git_hash', 'message',
+                                     'author')
         return os.linesep.join(
-            [(
-                '( hg:{hg_hash} | git:{git_hash} ) : {message} (by {author})'
-             ).format(**change) for change in self.changes]
+            '( hg:%s | git:%s ) : %s (by %s)' % fields(change)
+            for change in self.changes
         )
 
     def commit_update(self):
         """Commit the new dependency and potentially updated files."""
+        latest = self.changes[0]
         commit_msg = 'Issue {} - Update {} to {}'.format(
                 self.arguments.issue_number, self.arguments.dependency,
-                ' / '.join((self.changes[0]['hg_hash'],
-                            self.changes[0]['git_hash'])))
+                ' / '.join((latest['hg_hash'], latest['git_hash'])))
         try:
             self._update_dependencies_file()
             self._update_copied_code()
@@ -442,25 +671,60 @@ class DepUpdate(object):
     def __call__(self):
         """Let this class's objects be callable, run all desired tasks."""
         action_map = {
-            'diff': self.build_diff,
             'changes': self.build_changes,
             'issue': self.build_issue,
             'commit': self.commit_update,
         }
 
-        if len(self.changes) == 0:
+        # Only check the plain list of changes here, since e.g. a diff doesn't
+        # need any information about mirrored changes.
+        if len(self._get_change_list()) == 0:
             print('NO CHANGES FOUND. You are either trying to update to a '
                   'revision, which the dependency already is at - or '
                   'something went wrong while executing the vcs.')
             return
 
-        if self.arguments.lookup_inotes:
-            self.lookup_integration_notes()
+        filename = self.arguments.filename
+        streams_to_stdout = (self.arguments.action == 'diff' and
+                             filename is None)
 
-        output = action_map[self.arguments.action]()
-        if self.arguments.filename is not None:
-            with io.open(self.arguments.filename, 'w', encoding='utf-8') as fp:
-                fp.write(output)
-            print('Output writen to ' + self.arguments.filename)
+        notes_lookup = None
+        if self.arguments.lookup_inotes:
+            if streams_to_stdout:
+                # The notes need to be reported before the diff starts, instead
+                # of ending up in the middle of it.
+                self._try_lookup_integration_notes()
+            elif len(self.issue_ids) > 0:
+                # The issue IDs are determined above, before the issue tracker
+                # is queried in the background, while the requested action is
+                # processed.
+                notes_lookup = threading.Thread(
+                        target=self._try_lookup_integration_notes)
+                notes_lookup.start()
+
+        output = None
+        if self.arguments.action == 'diff':
+            # Let the VCS write a potentially huge diff directly to its
+            # destination, instead of buffering it
+            if filename is not None:
+                with io.open(filename, 'wb') as fp:
+                    self.build_diff(fp)
+            else:
+                sys.stdout.flush()
+                self.build_diff(getattr(sys.stdout, 'buffer', sys.stdout))
         else:
-            print(output)
+            output = action_map[self.arguments.action]()
+
+        # Any found notes are reported before the action's output
+        if notes_lookup is not None:
+            notes_lookup.join()
+
+        if output is not None:
+            if filename is not None:
+                with io.open(filename, 'w', encoding='utf-8') as fp:
+                    fp.write(output)
+            else:
+                print(output)
+
+        if filename is not None:
+            print('Output writen to ' + filename)
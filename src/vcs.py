@@ -17,23 +17,50 @@
 
 from __future__ import print_function, unicode_literals
 
+import bisect
+import email.utils
 import io
-import json
 import logging
 import os
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+try:
+    # Optionally decode Mercurial's log with a faster JSON parser, if it is
+    # installed.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 logging.basicConfig()
 logger = logging.getLogger('vcs')
 
 
+def _timestamp(date):
+    """Convert an RFC 2822 date, as logged by either VCS, to a timestamp."""
+    return email.utils.mktime_tz(email.utils.parsedate_tz(date))
+
+
+def _remove_tree(path):
+    """Delete as much of a directory tree as possible, reporting leftovers."""
+    shutil.rmtree(path, ignore_errors=True)
+    if os.path.exists(path):
+        logger.warn('warning: could not completely delete ' + path)
+
+
 class Vcs(object):
     """Baseclass for Git and Mercurial."""
 
-    JSON_DQUOTES = '__DQ__'
+    # Separators of the fields and records in Cls.MIRROR_LOG_FORMAT's and
+    # Git.LOG_FORMAT's output
+    FIELD_SEPARATOR = '\x1f'
+    RECORD_SEPARATOR = '\x1e'
+    # Seconds, for which a pulled / fetched history is considered up to date
+    UPDATE_INTERVAL = 60
 
     class VcsException(Exception):
         """Raised when no distinct VCS for a given repository was found."""
@@ -50,6 +77,8 @@ class Vcs(object):
 
         """
         self._source, self._repository = os.path.split(location)
+        # Whether pulling / fetching waits for Vcs.UPDATE_INTERVAL to pass
+        self.throttle_updates = True
         if not os.path.exists(location) or force_clone:
             self._make_temporary(location)
             self._clean_up = True
@@ -63,8 +92,17 @@ class Vcs(object):
 
     def __exit__(self, exc_type, exc_value, traceback):
         """Exit the object'c context and delete any temporary data."""
+        self.close()
         if self._clean_up:
-            shutil.rmtree(self._cwd)
+            # Move the temporary repository out of the way right away, but
+            # delete it in the background. The interpreter waits for the
+            # deletion to finish, before exiting.
+            doomed = self._cwd + '.delete'
+            os.rename(self._cwd, doomed)
+            threading.Thread(target=_remove_tree, args=(doomed,)).start()
+
+    def close(self):
+        """Release any resources held for running the VCS."""
 
     @classmethod
     def is_vcs_for_repo(cls, path):
@@ -77,26 +115,71 @@ class Vcs(object):
         try:
             return subprocess.check_output(
                 cmd,
-                cwd=os.path.join(self._cwd),
+                cwd=self._cwd,
                 stderr=subprocess.STDOUT,
-            ).decode('utf-8')
+            ).decode('utf-8', 'replace')
         except subprocess.CalledProcessError as e:
-            logger.error(e.output.decode('utf-8'))
+            logger.error(e.output.decode('utf-8', 'replace'))
             sys.exit(1)
 
-    def _get_latest(self):
-        self.run_cmd(self.UPDATE_LOCAL_HISTORY)
+    def stream_cmd(self, out_fp, *args):
+        """Run the vcs with the given commands, writing its output to out_fp.
 
-    def _escape_changes(self, changes):
-        return changes.replace('"', '\\"').replace(self.JSON_DQUOTES, '"')
+        The output is not buffered in memory, out_fp therefore needs to be a
+        binary file object with a file descriptor.
+        """
+        cmd = self.BASE_CMD + args
+        process = subprocess.Popen(
+            cmd,
+            cwd=self._cwd,
+            stdout=out_fp,
+            stderr=subprocess.PIPE,
+        )
+        _, error = process.communicate()
+        if process.returncode != 0:
+            logger.error(error.decode('utf-8', 'replace'))
+            sys.exit(1)
 
-    def _changes_as_json(self, changes):
-        return json.loads(
-            '[{}]'.format(','.join(
-                self._escape_changes(changes).strip().splitlines()
-            )))
+    def _get_latest(self, force=False):
+        # Remember the last update inside the VCS' own directory, so that it
+        # doesn't show up as a change in the repository.
+        stamp = os.path.join(self._cwd, self.VCS_REQUIREMENT, 'depup-updated')
+        if not force and self.throttle_updates and \
+                os.path.exists(stamp) and \
+                time.time() - os.path.getmtime(stamp) < self.UPDATE_INTERVAL:
+            return
 
-    def merged_diff(self, rev_a, rev_b, n_unified=16):
+        self.run_cmd(self.UPDATE_LOCAL_HISTORY)
+        if os.path.isdir(os.path.dirname(stamp)):
+            with io.open(stamp, 'a'):
+                os.utime(stamp, None)
+
+    def _get_latest_for(self, *revisions):
+        local_hashes = {rev: self._local_hash(rev) for rev in revisions}
+
+        # A revision, which can't be resolved at all (e.g. the hash of a
+        # change pushed just now), can't wait for the update interval to pass.
+        if None in local_hashes.values():
+            self._get_latest(force=True)
+        # Names like bookmarks or branches might have moved remotely, so the
+        # history is only left as it is, if all revisions are hashes of
+        # already known changes.
+        elif not all(local_hash.startswith(rev)
+                     for rev, local_hash in local_hashes.items()):
+            self._get_latest()
+
+    def _parse_log(self, output):
+        # Each line holds one change as a JSON object
+        return [json_loads(line) for line in output.splitlines()
+                if line.strip()]
+
+    def _split_records(self, output):
+        # Git separates formatted records by an additional newline
+        return [record.lstrip('\n')
+                for record in output.split(self.RECORD_SEPARATOR)
+                if record.strip()]
+
+    def merged_diff(self, rev_a, rev_b, n_unified=16, out_fp=None):
         """Invoke the VCS' functionality to create a unified diff.
 
         Parameters:
@@ -104,12 +187,16 @@ class Vcs(object):
             rev_b: The revision representing the end. Defaults to
                    Cls.DEFAULT_NEW_REVISION
             n_unified: The amount of context lines to add to the diff.
+            out_fp: When specified, the diff is directly written to this
+                    binary file object (see Vcs.stream_cmd), rather than
+                    being returned.
 
         """
-        return self.run_cmd('diff', '--unified=' + str(n_unified),
-                            *(self._rev_comb(
-                                rev_a,
-                                rev_b or self.DEFAULT_NEW_REVISION)))
+        args = ('diff', '--unified=' + str(n_unified)) + self._rev_comb(
+                rev_a, rev_b or self.DEFAULT_NEW_REVISION)
+        if out_fp is not None:
+            return self.stream_cmd(out_fp, *args)
+        return self.run_cmd(*args)
 
     def change_list(self, rev_a, rev_b):
         """Return the repository's history from revisions a to b as JSON.
@@ -120,13 +207,35 @@ class Vcs(object):
                    Cls.DEFAULT_NEW_REVISION
 
         """
-        self._get_latest()
+        rev_b = rev_b or self.DEFAULT_NEW_REVISION
+        self._get_latest_for(rev_a, rev_b)
+        return self._log_changes(rev_a, rev_b)
+
+    def directed_change_list(self, rev_a, rev_b):
+        """Return the repository's history between revisions a and b.
+
+        In contrast to Vcs.change_list, the history is also returned if rev_b
+        is an ancestor of rev_a. Returns a tuple of the list of changes and
+        whether these lead from rev_b back to rev_a.
+
+        Parameters:
+            rev_a: The revision representing the start.
+            rev_b: The revision representing the end. Defaults to
+                   Cls.DEFAULT_NEW_REVISION
+
+        """
+        rev_b = rev_b or self.DEFAULT_NEW_REVISION
+        self._get_latest_for(rev_a, rev_b)
 
-        log_format = self._log_format()
-        rev_cmd = self._rev_comb(rev_a, rev_b or self.DEFAULT_NEW_REVISION)
+        changes = self._log_changes(rev_a, rev_b)
+        if len(changes) > 0:
+            return changes, False
+        return self._log_changes(rev_b, rev_a), True
 
-        changes = self.run_cmd(*('log',) + log_format + rev_cmd)
-        return self._changes_as_json(changes)
+    def _log_changes(self, rev_a, rev_b):
+        rev_cmd = self._rev_comb(rev_a, rev_b)
+        changes = self.run_cmd(*('log',) + self.LOG_FORMAT + rev_cmd)
+        return self._parse_log(changes)
 
     def enhance_changes_information(self, changes, dependency_location, fake):
         """Enhance the change list with matching revisions from a mirror.
@@ -146,44 +255,203 @@ class Vcs(object):
         mirr_ex = self._other_cls.EXECUTABLE
 
         if not fake:
-            with self._other_cls(dependency_location) as mirror:
-                mirror._get_latest()
-
-                mirrored_hashes = {
-                        change['hash']: mirror.matching_hash(change['author'],
-                                                             change['date'],
-                                                             change['message'])
-                        for change in changes
-                }
+            mirrored_hashes = self._mapped_hashes(changes, dependency_location)
+            unmapped = [change for change in changes
+                        if change['hash'] not in mirrored_hashes]
         else:
             mirrored_hashes = {}
+            unmapped = []
 
+        if len(unmapped) > 0:
+            with self._other_cls(dependency_location) as mirror:
+                mirror.throttle_updates = self.throttle_updates
+                mirror._get_latest()
+                mirrored_hashes.update(mirror.matching_hashes(unmapped))
+
+        self_url_key, self_hash_key = self_ex + '_url', self_ex + '_hash'
+        mirr_url_key, mirr_hash_key = mirr_ex + '_url', mirr_ex + '_hash'
         for change in changes:
-            change[self_ex + '_url'] = self.REVISION_URL.format(
+            change[self_url_key] = self.REVISION_URL.format(
                     repository=self._repository, revision=change['hash'])
-            change[self_ex + '_hash'] = change['hash']
+            change[self_hash_key] = change['hash']
 
             mirrored_hash = mirrored_hashes.get(change['hash'], 'NO MIRROR')
             del change['hash']
 
-            change[mirr_ex + '_url'] = self._other_cls.REVISION_URL.format(
+            change[mirr_url_key] = self._other_cls.REVISION_URL.format(
                     repository=self._repository, revision=mirrored_hash)
-            change[mirr_ex + '_hash'] = mirrored_hash
+            change[mirr_hash_key] = mirrored_hash
+
+    def _mapped_hashes(self, changes, dependency_location):
+        """Look up the mirrored hashes in a hg-git mapfile, if there is one.
+
+        hg-git records the corresponding full Git and Mercurial hashes of each
+        converted commit in .hg/git-mapfile, one "<git hash> <hg hash>" pair
+        per line. Returns a dictionary, mapping the hashes of all found changes
+        to their mirrored hash.
+        """
+        mapfile = self._git_mapfile(dependency_location)
+        if not os.path.exists(mapfile):
+            return {}
+
+        hashes = {change['hash'] for change in changes}
+        lengths = {len(change_hash) for change_hash in hashes}
+        own_column = self.GIT_MAPFILE_COLUMN
+
+        full_hashes = {}
+        mirror_hashes = []
+        with io.open(mapfile, 'r', encoding='ascii') as fp:
+            for line in fp:
+                columns = line.split()
+                if len(columns) < 2:
+                    continue
+                mirror_hashes.append(columns[1 - own_column])
+                for length in lengths:
+                    own_hash = columns[own_column][:length]
+                    if own_hash in hashes:
+                        full_hashes[own_hash] = columns[1 - own_column]
+
+        mirror_hashes.sort()
+        abbreviations = self._other_cls._abbreviations(
+                set(full_hashes.values()), mirror_hashes,
+                os.path.dirname(mapfile))
+        return {own_hash: abbreviations[full_hash]
+                for own_hash, full_hash in full_hashes.items()}
+
+    @classmethod
+    def _abbreviations(cls, full_hashes, mapped_hashes, hg_dir):
+        """Abbreviate hashes read from a hg-git mapfile, like the log does.
+
+        Parameters: full_hashes - The hashes to abbreviate
+                    mapped_hashes - A sorted list of all of the mapfile's
+                                    hashes of this VCS
+                    hg_dir - The .hg directory, containing the mapfile
+
+        Returns a dictionary, mapping each full hash to its abbreviation.
+        """
+        # Mercurial's short hashes have a fixed length
+        return {full_hash: full_hash[:cls.SHORT_HASH_LENGTH]
+                for full_hash in full_hashes}
+
+    def matching_hashes(self, changes):
+        """Get the responsible commits for the given changes.
+
+        A commit must satisfy equality for author, date and commit message, in
+        order to be recognized as the matching commit. All candidates are
+        listed by a single log, starting at the earliest change's date.
+        Returns a dictionary, mapping the hash of each change to the matching
+        commit's hash, or to an empty string, if none was found.
+
+        Parameters:
+            changes: A list of dictionaries with the keys "hash", "author",
+                     "date" and "message", as in Vcs.change_list's result.
+
+        """
+        timestamps = [_timestamp(change['date']) for change in changes]
+        earliest = changes[timestamps.index(min(timestamps))]['date']
+        output = self.run_cmd(*('log',) + self.MIRROR_LOG_FORMAT +
+                              self._since(earliest))
+
+        candidates = {}
+        for record in self._split_records(output):
+            commit_hash, author, date, message = record.split(
+                    self.FIELD_SEPARATOR)
+            candidates.setdefault(_timestamp(date), []).append(
+                    (commit_hash, author.lower(), ' '.join(message.split())))
+
+        matching_hashes = {}
+        for change, timestamp in zip(changes, timestamps):
+            author = change['author'].lower()
+            message = ' '.join(change['message'].split())
+            matches = [commit_hash for commit_hash, candidate_author,
+                       candidate_message in candidates.get(timestamp, [])
+                       if author in candidate_author and
+                       message in candidate_message]
+            if len(matches) > 1:
+                raise Vcs.VcsException('FATAL: Ambiguous commit filter!')
+            matching_hashes[change['hash']] = ''.join(matches)
+        return matching_hashes
 
     @staticmethod
     def factory(location, force_clone=False):
         """Get a suiting Vcs instance for the given repository path."""
-        obj = None
-        for cls in [Git, Mercurial]:
-            if cls.is_vcs_for_repo(location):
-                if obj is not None:
-                    raise Vcs.VcsException(
-                            "Found multiple possible VCS' for " + location)
-                obj = cls(location, force_clone)
-
-        if obj is None:
+        # Only instantiate the VCS, once it is known to be the only match
+        matches = [cls for cls in [Git, Mercurial]
+                   if cls.is_vcs_for_repo(location)]
+
+        if len(matches) > 1:
+            raise Vcs.VcsException(
+                    "Found multiple possible VCS' for " + location)
+        if len(matches) == 0:
             raise Vcs.VcsException('No valid VCS found for ' + location)
-        return obj
+        return matches[0](location, force_clone)
+
+
+class _CommandServer(object):
+    """Minimal client for Mercurial's command server.
+
+    The command server keeps a single hg process running for any number of
+    commands, see https://www.mercurial-scm.org/wiki/CommandServer
+    """
+
+    def __init__(self, base_cmd, cwd):
+        self._process = subprocess.Popen(
+            base_cmd + ('serve', '--cmdserver', 'pipe'),
+            cwd=cwd,
+            # Let Mercurial encode any output as UTF-8, regardless of the
+            # locale.
+            env=dict(os.environ, HGENCODING='utf-8'),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        # Skip the server's hello message
+        self._read_channel()
+
+    def _read_channel(self):
+        header = self._process.stdout.read(5)
+        if len(header) < 5:
+            raise Vcs.VcsException('Mercurial command server terminated')
+        channel, length = struct.unpack(str('>cI'), header)
+        if channel in b'IL':
+            # Input requests only announce the maximum length
+            return channel, length
+        return channel, self._process.stdout.read(length)
+
+    def _write(self, data):
+        self._process.stdin.write(data)
+        self._process.stdin.flush()
+
+    def run_command(self, out_fp, *args):
+        """Run a command, writing its output to out_fp.
+
+        Returns a tuple of the command's return code and its error output.
+        """
+        data = '\0'.join(args).encode('utf-8')
+        self._write(b'runcommand\n' + struct.pack(str('>I'), len(data)) +
+                    data)
+
+        error = b''
+        while True:
+            channel, data = self._read_channel()
+            if channel == b'o':
+                out_fp.write(data)
+            elif channel == b'e':
+                error += data
+            elif channel == b'r':
+                return struct.unpack(str('>i'), data)[0], error
+            elif channel in b'IL':
+                # Commands are run non-interactively, answer with an empty
+                # input.
+                self._write(struct.pack(str('>I'), 0))
+            elif channel.isupper():
+                raise Vcs.VcsException(
+                    'Unexpected Mercurial command server channel: ' +
+                    channel.decode('utf-8'))
+
+    def close(self):
+        """Stop the command server."""
+        self._process.stdin.close()
+        self._process.wait()
 
 
 class Mercurial(Vcs):
@@ -194,44 +462,79 @@ class Mercurial(Vcs):
     BASE_CMD = (EXECUTABLE, '--config', 'defaults.log=', '--config',
                 'defaults.pull=', '--config', 'defaults.diff=')
     UPDATE_LOCAL_HISTORY = 'pull'
-    LOG_TEMLATE = ('\\{"hash":"{node|short}","author":"{author|person}",'
-                   '"date":"{date|rfc822date}","message":"{desc|strip|'
-                   'firstline}"}\n')
+    # Mercurial's json filter takes care of escaping all values
+    LOG_TEMLATE = ('\\{"hash":{node|short|json},"author":{author|person|json},'
+                   '"date":{date|rfc822date|json},"message":{desc|strip|'
+                   'firstline|json}}\n')
+    LOG_FORMAT = ('--template', LOG_TEMLATE)
+    MIRROR_LOG_FORMAT = ('--template', '{node|short}\\x1f{author}\\x1f'
+                         '{date|rfc822date}\\x1f{desc}\\x1e')
     DEFAULT_NEW_REVISION = 'master'
+    SHORT_HASH_LENGTH = 12
+    GIT_MAPFILE_COLUMN = 1
 
     REVISION_URL = 'https://hg.adblockplus.org/{repository}/rev/{revision}'
 
     def __init__(self, *args):
         """Construct a Mercurial object and specify Git as the mirror class."""
         self._other_cls = Git
+        self._command_server = None
         super(Mercurial, self).__init__(*args)
 
+    def run_cmd(self, *args, **kwargs):
+        """Run hg with the given commands, using a shared command server."""
+        output = io.BytesIO()
+        self.stream_cmd(output, *args)
+        return output.getvalue().decode('utf-8', 'replace')
+
+    def stream_cmd(self, out_fp, *args):
+        """Run hg with the given commands, writing its output to out_fp.
+
+        All commands are run by a single command server, which is started on
+        first use and avoids spawning a new hg process for each command.
+        """
+        returncode, error = self._run_command(out_fp, *args)
+        if returncode != 0:
+            logger.error(error.decode('utf-8', 'replace'))
+            sys.exit(1)
+
+    def _run_command(self, out_fp, *args):
+        if self._command_server is None:
+            self._command_server = _CommandServer(self.BASE_CMD, self._cwd)
+        return self._command_server.run_command(
+                out_fp, *(self.BASE_CMD[1:] + args))
+
+    def close(self):
+        """Stop the command server, if it was started."""
+        if self._command_server is not None:
+            self._command_server.close()
+            self._command_server = None
+
     def _rev_comb(self, rev_a, rev_b):
         # Only take into account those changesets, which are actually affecting
         # the repository's content. See
         # https://www.mercurial-scm.org/repo/hg/help/revsets
         return ('-r', '{}::{}'.format(rev_a, rev_b))
 
-    def _log_format(self):
-        log_format = self.LOG_TEMLATE.replace('"', self.JSON_DQUOTES)
-        return ('--template', log_format)
+    def _git_mapfile(self, dependency_location):
+        return os.path.join(self._cwd, '.hg', 'git-mapfile')
 
-    def change_list(self, *args):
-        """Apply measures for hg log and call Vcs's change_list."""
+    def _local_hash(self, rev):
+        output = io.BytesIO()
+        returncode, _ = self._run_command(output, 'log', '-r', rev,
+                                          '--template', '{node}')
+        if returncode != 0:
+            return None
+        return output.getvalue().decode('ascii')
+
+    def _log_changes(self, *args):
         # Mercurial's command for producing a log between revisions using the
         # revision set produced by self._rev_comb returns the changesets in a
         # reversed order. Additionally the current revision is returned.
-        return list(reversed(super(Mercurial, self).change_list(*args)[1:]))
-
-    def matching_hash(self, author, date, message):
-        """Get the responsible commit for the given information.
+        return list(reversed(super(Mercurial, self)._log_changes(*args)[1:]))
 
-        A commit must stafisy equailty for author, date and commit message, in
-        order to be recognized as the matching commit.
-
-        """
-        return self.run_cmd('log', '-u', author, '-d', date, '--keyword',
-                            message, '--template', '{node|short}')
+    def _since(self, date):
+        return ('-d', '>' + date)
 
     def _make_temporary(self, location):
         self._cwd = tempfile.mkdtemp()
@@ -262,8 +565,17 @@ class Git(Vcs):
     VCS_REQUIREMENT = '.git'
     BASE_CMD = (EXECUTABLE,)
     UPDATE_LOCAL_HISTORY = 'fetch'
-    LOG_TEMLATE = '{"hash":"%h","author":"%an","date":"%aD","message":"%s"}'
+    # Fields and records are separated by control characters, which don't
+    # occur in any of the values, so nothing needs to be escaped.
+    LOG_FIELDS = ('hash', 'author', 'date', 'message')
+    LOG_TEMLATE = '%h%x1f%an%x1f%aD%x1f%s%x1e'
+    LOG_FORMAT = ('--pretty=format:' + LOG_TEMLATE,)
+    # Prefixes each change with its side of a symmetric difference
+    DIRECTED_LOG_FORMAT = ('--left-right', '--pretty=format:%m' + LOG_TEMLATE)
+    MIRROR_LOG_FORMAT = ('--pretty=format:%h%x1f%an <%ae>%x1f%aD%x1f%B%x1e',)
     DEFAULT_NEW_REVISION = 'origin/master'
+    SHORT_HASH_LENGTH = 7
+    GIT_MAPFILE_COLUMN = 0
 
     REVISION_URL = ('https://www.github.com/adblockplus/{repository}/commit/'
                     '{revision}')
@@ -276,34 +588,114 @@ class Git(Vcs):
     def _rev_comb(self, rev_a, rev_b):
         return ('{}..{}'.format(rev_a, rev_b),)
 
-    def _log_format(self):
-        return ('--pretty=format:{}'.format(self.LOG_TEMLATE.replace(
-            '"', self.JSON_DQUOTES)),)
+    def _parse_log(self, output):
+        return [self._parse_record(record)
+                for record in self._split_records(output)]
 
-    def matching_hash(self, author, date, message):
-        """Get the responsible commit for the given information.
+    def _parse_record(self, record):
+        return dict(zip(self.LOG_FIELDS, record.split(self.FIELD_SEPARATOR)))
 
-        A commit must stafisy equailty for author, date and commit message, in
-        order to be recognized as the matching commit.
+    def directed_change_list(self, rev_a, rev_b):
+        """Return the history between revisions a and b in either direction.
 
+        See Vcs.directed_change_list. Both directions are determined by a
+        single log of the revisions' symmetric difference.
         """
-        # Git does not implement exact date matching directly. Additionally,
-        # git is only capable of filtering by COMMIT DATE instead of
+        rev_b = rev_b or self.DEFAULT_NEW_REVISION
+        self._get_latest_for(rev_a, rev_b)
+        output = self.run_cmd(*('log',) + self.DIRECTED_LOG_FORMAT + (
+            '{}...{}'.format(rev_a, rev_b),))
+
+        forward = []
+        backward = []
+        for record in self._split_records(output):
+            if record.startswith('>'):
+                forward.append(self._parse_record(record[1:]))
+            elif record.startswith('<'):
+                backward.append(self._parse_record(record[1:]))
+
+        if len(forward) > 0:
+            return forward, False
+        return backward, True
+
+    def _git_mapfile(self, dependency_location):
+        return os.path.join(dependency_location, '.hg', 'git-mapfile')
+
+    @classmethod
+    def _abbreviations(cls, full_hashes, mapped_hashes, hg_dir):
+        # Git's abbreviations grow with the repository, so they are taken from
+        # the Git repository hg-git keeps next to the mapfile, if possible.
+        abbreviations = {}
+        git_dir = os.path.join(hg_dir, 'git')
+        if len(full_hashes) > 0 and os.path.isdir(git_dir):
+            process = subprocess.Popen(
+                (cls.EXECUTABLE, '--git-dir', git_dir, 'log', '--no-walk',
+                 '--ignore-missing', '--format=%H %h') + tuple(full_hashes),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            output, _ = process.communicate()
+            if process.returncode == 0:
+                abbreviations.update(
+                        line.split()
+                        for line in output.decode('ascii').splitlines())
+
+        # Otherwise, extend the minimal length until the abbreviation is
+        # unambiguous among the mapped hashes, as Git does.
+        for full_hash in full_hashes:
+            if full_hash in abbreviations:
+                continue
+            index = bisect.bisect_left(mapped_hashes, full_hash)
+            length = cls.SHORT_HASH_LENGTH
+            for neighbour in (mapped_hashes[max(index - 1, 0):index] +
+                              mapped_hashes[index + 1:index + 2]):
+                common = os.path.commonprefix((neighbour, full_hash))
+                length = max(length, len(common) + 1)
+            abbreviations[full_hash] = full_hash[:length]
+        return abbreviations
+
+    def _try_cmd(self, *args):
+        # Like Vcs.run_cmd, but returns None instead of exiting on failure
+        process = subprocess.Popen(
+            self.BASE_CMD + args,
+            cwd=self._cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        output, _ = process.communicate()
+        if process.returncode != 0:
+            return None
+        return output.decode('utf-8', 'replace')
+
+    def _local_hash(self, rev):
+        output = self._try_cmd('rev-parse', '--verify', '--quiet',
+                               rev + '^{commit}')
+        if output is None:
+            return None
+        return output.strip()
+
+    def _since(self, date):
+        # Git is only capable of filtering by COMMIT DATE instead of
         # AUTHOR DATE (which is what we are actually looking for), see
         # https://stackoverflow.com/q/37311494/
         # Since naturally the COMMIT DATE allways is later then the AUTHOR
         # DATE, we are at least able to limit the valid range to after our
         # given date
-        result = self.run_cmd('log', '--author={}'.format(author),
-                              '--grep={}'.format(message),
-                              '--after={}'.format(date), '--pretty=format:%h')
-        if len(result.split()) > 1:
-            raise Vcs.VcsException('FATAL: Ambiguous commit filter!')
-        return result
+        return ('--after=' + date,)
 
     def _make_temporary(self, location):
         self._cwd = tempfile.mkdtemp()
-        self.run_cmd('clone', '--bare', location, self._cwd)
+        # Only commit metadata is needed for looking up mirrored hashes, so
+        # skip any file contents, tags and other branches.
+        if self._try_cmd('clone', '--bare', '--filter=blob:none', '--no-tags',
+                         '--single-branch', location, self._cwd) is None:
+            # Older Git versions or servers don't support partial clones.
+            # Start over with a complete one, which also reports any other
+            # error.
+            shutil.rmtree(self._cwd)
+            os.mkdir(self._cwd)
+            self.run_cmd('clone', '--bare', '--no-tags', '--single-branch',
+                         location, self._cwd)
 
     def commit_changes(self, msg):
         """Add any local changes and commit the with <msg>."""
@@ -0,0 +1,57 @@
+# This file is part of Adblock Plus <https://adblockplus.org/>,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module contains the tests for src/dependencies.py."""
+
+from __future__ import unicode_literals
+
+from src.dependencies import read_deps
+
+DEPENDENCIES = """\
+_root = hg:https://hg.adblockplus.org/ git:https://github.com/adblockplus/
+_self = buildtools/ensure_dependencies.py
+# A comment
+buildtools = buildtools hg:9a56d76cd951 git:9643c0b
+adblockpluscore = adblockpluscore hg:1234 git:https://example.com/core@abc
+elemhidehelper = remote-name 1.2 hg:https://example.com/ehh@5678 hg:9abc
+"""
+
+
+def test_read_deps(tmpdir):
+    """Test parsing of a dependencies file."""
+    tmpdir.join('dependencies').write(DEPENDENCIES)
+
+    deps = read_deps(str(tmpdir))
+
+    assert deps['_root'] == {'hg': 'https://hg.adblockplus.org/',
+                             'git': 'https://github.com/adblockplus/'}
+    assert deps['_self'] == {'*': 'buildtools/ensure_dependencies.py'}
+    assert deps['buildtools'] == {'*': ('buildtools', None),
+                                  'hg': (None, '9a56d76cd951'),
+                                  'git': (None, '9643c0b')}
+    assert deps['adblockpluscore'] == {
+        '*': ('adblockpluscore', None),
+        'hg': (None, '1234'),
+        'git': ('https://example.com/core', 'abc'),
+    }
+    assert deps['elemhidehelper'] == {
+        '*': ('remote-name', '1.2'),
+        'hg': ('https://example.com/ehh', '9abc'),
+    }
+
+
+def test_missing_dependencies_file(tmpdir):
+    """Test reading a repository without a dependencies file."""
+    assert read_deps(str(tmpdir)) is None
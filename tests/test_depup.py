@@ -0,0 +1,283 @@
+# This file is part of Adblock Plus <https://adblockplus.org/>,
+# Copyright (C) 2006-present eyeo GmbH
+#
+# Adblock Plus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# Adblock Plus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Adblock Plus.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module contains the tests for src/depup.py."""
+
+from __future__ import unicode_literals
+
+import logging
+import os
+import re
+import socket
+import subprocess
+import threading
+
+import pytest
+
+from src import depup
+from src.depup import DepUpdate
+
+DEPENDENCIES = """\
+_root = hg:https://hg.adblockplus.org/ git:https://github.com/adblockplus/
+testrepo2 = testrepo2 hg:1111 git:2222
+{}
+"""
+
+LATEST_CHANGE = {'hg_hash': 'aaaaaaaaaaaa', 'git_hash': 'bbbbbbb'}
+
+# The status, location and content of the issue tracker's pages
+TICKETS = {
+    ('issues.adblockplus.org', '/ticket/1'): (200, None,
+                                              b'<h2>Integration Notes</h2>'),
+    ('issues.adblockplus.org', '/ticket/2'): (200, None, b'<h2>Notes</h2>'),
+    ('issues.adblockplus.org', '/ticket/3'): (301, '/ticket/1', b''),
+    ('issues.adblockplus.org', '/ticket/4'): (302, 'https://example.com/4',
+                                              b''),
+    ('example.com', '/4'): (200, None, b'integration notes'),
+    ('issues.adblockplus.org', '/ticket/5'): (404, None, b'Not Found'),
+}
+
+
+class _Response(object):
+    def __init__(self, status, location, content):
+        self.status = status
+        self.reason = 'Reason'
+        self._location = location
+        self._content = content
+
+    def getheader(self, name, default=None):
+        return self._location if name == 'Location' else default
+
+    def read(self):
+        return self._content
+
+
+class _Connection(object):
+    """Stub for HTTPSConnection, serving the pages in TICKETS."""
+
+    def __init__(self, host, timeout=None):
+        self.host = host
+        self.requests = []
+        self.errors = []
+        self.closed = 0
+
+    def request(self, method, path):
+        self.requests.append(path)
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+
+    def getresponse(self):
+        return _Response(*TICKETS[(self.host, self.requests[-1])])
+
+    def close(self):
+        self.closed += 1
+
+
+@pytest.fixture
+def root_repo(tmpdir, monkeypatch):
+    """Create a clean git repository, with a dependency called testrepo."""
+    root_dir = tmpdir.mkdir('root')
+    subprocess.check_output(('git', 'init', '-q', str(root_dir.mkdir(
+        'testrepo'))))
+
+    subprocess.check_output(('git', 'init', '-q', str(root_dir)))
+    root_dir.join('.gitignore').write('testrepo\n')
+    subprocess.check_output(('git', 'add', '.gitignore'), cwd=str(root_dir))
+
+    monkeypatch.chdir(str(root_dir))
+    return root_dir
+
+
+def write_dependencies_file(root_repo, entry):
+    """Commit a dependencies file, containing the given entry."""
+    deps_file = root_repo.join('dependencies')
+    deps_file.write(DEPENDENCIES.format(entry))
+    subprocess.check_output(('git', 'add', 'dependencies'))
+    subprocess.check_output(('git', 'commit', '-q', '-m', 'Dependencies'))
+    return deps_file
+
+
+def update_dependencies_file(root_repo, entry):
+    """Update testrepo's entry, return the new dependencies file."""
+    deps_file = write_dependencies_file(root_repo, entry)
+
+    with DepUpdate('changes', 'testrepo') as update:
+        update._changes = [LATEST_CHANGE]
+        update._update_dependencies_file()
+
+    return deps_file.read()
+
+
+@pytest.mark.parametrize('entry,expected', [
+    ('testrepo = testrepo hg:1234 git:5678',
+     'testrepo = testrepo hg:aaaaaaaaaaaa git:bbbbbbb'),
+    ('  testrepo   =testrepo  hg:1234\tgit:5678  ',
+     'testrepo = testrepo hg:aaaaaaaaaaaa git:bbbbbbb  '),
+    ('testrepo = testrepo hg:1234 git:5678  # A comment',
+     'testrepo = testrepo hg:aaaaaaaaaaaa git:bbbbbbb  # A comment'),
+    ('testrepo = remote-name 1234',
+     'testrepo = remote-name hg:aaaaaaaaaaaa git:bbbbbbb'),
+    ('testrepo = testrepo hg:https://example.com/x@1234 git:5678',
+     'testrepo = testrepo hg:https://example.com/x@aaaaaaaaaaaa '
+     'git:bbbbbbb'),
+])
+def test_update_dependencies_file(root_repo, entry, expected):
+    """Test rewriting only the dependency's own entry."""
+    assert update_dependencies_file(root_repo, entry) == (
+        DEPENDENCIES.format(expected))
+
+
+def test_up_to_date_dependencies_file(root_repo):
+    """Test leaving an up to date dependencies file untouched."""
+    deps_file = write_dependencies_file(
+        root_repo, 'testrepo = testrepo hg:aaaaaaaaaaaa git:bbbbbbb')
+
+    with DepUpdate('changes', 'testrepo') as update:
+        update._changes = [LATEST_CHANGE]
+        os.utime(str(deps_file), (0, 0))
+        update._update_dependencies_file()
+
+    assert os.path.getmtime(str(deps_file)) == 0
+
+
+def test_missing_dependency_entry(root_repo):
+    """Test failing, if the dependency has no entry to update."""
+    write_dependencies_file(root_repo, '')
+
+    with DepUpdate('changes', 'testrepo') as update:
+        # The entry might e.g. have been removed since the file was parsed
+        update._dep_config = {'testrepo': {'*': ('testrepo', None)}}
+        update._changes = [LATEST_CHANGE]
+        with pytest.raises(SystemExit) as excinfo:
+            update._update_dependencies_file()
+
+    assert excinfo.value.code == 1
+
+
+def test_commit_updates_unthrottled(root_repo):
+    """Test always updating the dependency's history for a commit."""
+    write_dependencies_file(root_repo, 'testrepo = testrepo hg:1234 git:5678')
+
+    with DepUpdate('changes', 'testrepo') as update:
+        assert update._main_vcs.throttle_updates
+    with DepUpdate('commit', 'testrepo', '1234') as update:
+        assert not update._main_vcs.throttle_updates
+
+
+@pytest.fixture
+def dep_update(root_repo, monkeypatch):
+    """Provide a DepUpdate for testrepo, with a stubbed issue tracker."""
+    write_dependencies_file(root_repo, 'testrepo = testrepo hg:1234 git:5678')
+    monkeypatch.setattr(depup, 'HTTPSConnection', _Connection)
+
+    with DepUpdate('changes', 'testrepo') as update:
+        yield update
+
+
+def connect(host='issues.adblockplus.org'):
+    """Provide the current thread's connections, with one to host."""
+    connection = _Connection(host)
+    return connection, {threading.current_thread().ident: connection}
+
+
+@pytest.mark.parametrize('issue_id,expected', [
+    ('1', 'https://issues.adblockplus.org/ticket/1'),
+    ('2', None),
+    ('3', 'https://issues.adblockplus.org/ticket/1'),
+    ('4', 'https://example.com/4'),
+])
+def test_integration_notes_url(dep_update, issue_id, expected):
+    """Test searching issues for integration notes, following redirects."""
+    connection, connections = connect()
+
+    assert dep_update._integration_notes_url(connections, issue_id) == (
+        expected)
+    assert connection.closed == 0
+
+
+def test_integration_notes_dropped_connection(dep_update):
+    """Test retrying once, if the issue tracker closed an idle connection."""
+    connection, connections = connect()
+    connection.errors.append(depup.BadStatusLine(''))
+
+    assert dep_update._integration_notes_url(connections, '1') == (
+        'https://issues.adblockplus.org/ticket/1')
+    assert connection.requests == ['/ticket/1', '/ticket/1']
+    assert connection.closed == 1
+
+
+def test_integration_notes_timeout(dep_update):
+    """Test not retrying a request, which timed out."""
+    connection, connections = connect()
+    connection.errors.append(socket.timeout('timed out'))
+
+    with pytest.raises(socket.timeout):
+        dep_update._integration_notes_url(connections, '1')
+    assert connection.requests == ['/ticket/1']
+
+
+def test_integration_notes_error_status(dep_update, caplog):
+    """Test warning about issues, which can't be looked up."""
+    connection, connections = connect()
+
+    with caplog.at_level(logging.WARNING, logger='depup'):
+        assert dep_update._integration_notes_url(connections, '5') is None
+    assert 'could not look up issue 5: 404 Reason' in caplog.text
+
+
+@pytest.mark.parametrize('message,expected', [
+    ('Issue 1 - Foo', ('1', False)),
+    ('Fixes 22 - Foo', ('22', False)),
+    ('Foo, issue 1, issue 2', ('1', False)),
+    ('Noissue - Foo', (None, True)),
+    ('noissue: Foo', (None, True)),
+    ('Noissue - fixes issue 1', ('1', True)),
+    ('Foo - noissue', (None, False)),
+    ('Noissues - Foo', (None, False)),
+    ('reissue 5', (None, False)),
+    ('prefixes 5', (None, False)),
+    ('Issue 5a', (None, False)),
+    ('Foo', (None, False)),
+    ('Foo\n\nFixes issue\n4', ('4', False)),
+    ('Noissue\nIssue 6', ('6', True)),
+])
+def test_match_reference(dep_update, message, expected):
+    """Test matching issue references, like the former pair of patterns."""
+    assert dep_update._match_reference(message) == expected
+
+    # Formerly, the first issue number was searched anywhere and "noissue"
+    # only at the message's start.
+    issue_match = re.search(r'\b(issue|fixes)\s+(\d+)\b', message, re.I)
+    assert expected == (issue_match.group(2) if issue_match else None,
+                        bool(re.search(r'^noissue\b', message, re.I)))
+
+
+def test_parsed_changes(dep_update, caplog):
+    """Test separating changes with an issue reference from the others."""
+    changes = [
+        {'message': message, 'hg_hash': str(i), 'git_hash': str(i)}
+        for i, message in enumerate(['Issue 12 - Foo', 'Noissue - Bar',
+                                     'Fixes 3 - Baz', 'Qux', 'Issue 12'])
+    ]
+    dep_update._changes = changes
+
+    with caplog.at_level(logging.WARNING, logger='depup'):
+        parsed_changes = dep_update.parsed_changes
+
+    assert parsed_changes == {'issue_ids': ('3', '12'),
+                              'noissues': (changes[1], changes[3])}
+    assert dep_update.issue_ids == ('3', '12')
+    assert '"Qux" (commit 3 | 3)' in caplog.text
+    assert 'Bar' not in caplog.text
@@ -18,17 +18,23 @@
 from __future__ import unicode_literals
 
 import io
+import logging
 import os
+import shutil
 import subprocess
+import time
 
 import pytest
 
-from src.vcs import Vcs, Git, Mercurial
+from src.vcs import Vcs, Git, Mercurial, _remove_tree
 
 DATA_DIR = os.path.join(
     os.path.realpath(os.path.dirname(__file__)), 'data'
 )
 
+# A revision before the latest one, in each of the test repositories
+PREVIOUS_REVISION = {Git: 'HEAD~1', Mercurial: '0'}
+
 
 class _VcsCmd(object):
     def __init__(self, executable, cwd):
@@ -83,6 +89,12 @@ def git_repo(tmpdir_factory):
     return git_dir
 
 
+@pytest.fixture(params=['git_repo', 'hg_repo'])
+def repo(request):
+    """Provide each of the test repositories in turn."""
+    return request.getfixturevalue(request.param)
+
+
 def test_factory(git_repo, hg_repo):
     """Test VCS determination."""
     assert Vcs.factory(str(git_repo)).__class__ == Git
@@ -107,44 +119,178 @@ def test_hash_lookup(git_repo, hg_repo):
 
     assert len(change_list_git) == len(change_list_hg)
     for i, change in enumerate(change_list_git):
+        # Each abbreviated hash refers to the change with the same message
+        hg_hash, git_hash = change['hg_hash'], change_list_hg[i]['git_hash']
+        assert hg._local_hash(hg_hash).startswith(hg_hash)
+        assert git._local_hash(git_hash).startswith(git_hash)
+        assert hg.run_cmd('log', '-r', hg_hash, '--template',
+                          '{desc|firstline}') == change['message']
+        assert git.run_cmd('log', '-1', '--format=%s',
+                           git_hash).strip() == change_list_hg[i]['message']
+
         assert change['hg_hash'] == change_list_hg[i]['hg_hash']
         assert change['git_hash'] == change_list_hg[i]['git_hash']
         assert change['hg_url'] == change_list_hg[i]['hg_url']
         assert change['git_url'] == change_list_hg[i]['git_url']
 
+    git.close()
+    hg.close()
+
 
-def test_dirty_check_and_clean(git_repo, hg_repo):
+def test_dirty_check_and_clean(repo):
     """Test discovering and cleaning of a dirty repository."""
-    for repo in [git_repo, hg_repo]:
-        vcs = Vcs.factory(str(repo))
+    vcs = Vcs.factory(str(repo))
 
-        repo.join('foobar.txt').write('foobar')
-        assert vcs.repo_is_clean() is False
+    repo.join('foobar.txt').write('foobar')
+    assert vcs.repo_is_clean() is False
 
-        vcs.undo_changes()
-        assert vcs.repo_is_clean()
+    vcs.undo_changes()
+    assert vcs.repo_is_clean()
 
-        repo.join('foo').write('bar')
-        assert vcs.repo_is_clean() is False
+    repo.join('foo').write('bar')
+    assert vcs.repo_is_clean() is False
 
 
-def test_tmp_cloning_and_cleanup(git_repo, hg_repo):
+def test_tmp_cloning_and_cleanup(repo):
     """Test cleanup after temporary cloning a repository."""
-    for repo in [git_repo, hg_repo]:
-        with Vcs.factory(str(repo), True) as tmp_repo:
-            tmp_dir = tmp_repo._cwd
-            tmp_repo._get_latest()
+    with Vcs.factory(str(repo), True) as tmp_repo:
+        tmp_dir = tmp_repo._cwd
+        tmp_repo._get_latest()
+
+    assert os.path.exists(tmp_dir) is False
 
-        assert os.path.exists(tmp_dir) is False
 
+def test_failed_cleanup(tmpdir, monkeypatch, caplog):
+    """Test reporting a temporary repository, which couldn't be deleted."""
+    monkeypatch.setattr(shutil, 'rmtree', lambda path, ignore_errors: None)
 
-def test_commit(git_repo, hg_repo):
+    with caplog.at_level(logging.WARNING, logger='vcs'):
+        _remove_tree(str(tmpdir))
+
+    assert 'could not completely delete ' + str(tmpdir) in caplog.text
+
+
+def test_commit(repo):
     """Test commit functionality of Vcs."""
-    for repo in [git_repo, hg_repo]:
-        vcs = Vcs.factory(str(repo))
+    vcs = Vcs.factory(str(repo))
+
+    repo.join('foobar.txt').write('foobar')
+
+    vcs.commit_changes('Testing commit')
+
+    assert 'Testing commit' in vcs.run_cmd('log')
+
+
+def test_streamed_diff(repo, tmpdir):
+    """Test writing a diff directly to a file."""
+    vcs = Vcs.factory(str(repo))
+    rev_a = PREVIOUS_REVISION[vcs.__class__]
+    diff_file = tmpdir.join('diff')
+
+    with io.open(str(diff_file), 'wb') as fp:
+        vcs.merged_diff(rev_a, 'master', out_fp=fp)
+
+    assert diff_file.read_binary().decode('utf-8') == vcs.merged_diff(
+        rev_a, 'master')
+
+
+def test_hash_lookup_from_git_mapfile(git_repo, tmpdir):
+    """Assert mirrored hashes being read from hg-git's mapfile."""
+    git = Vcs.factory(str(git_repo))
+    first_git_commit = git.run_cmd('rev-list', '--max-parents=0',
+                                   'HEAD').strip()
+    change_list = git.change_list(first_git_commit, 'master')
+
+    # The mirror is not a working repository, any fallback to a log query
+    # would fail.
+    mirror = tmpdir.mkdir('mirror')
+    lines = []
+    for i, change in enumerate(change_list):
+        full_hash = git.run_cmd('rev-parse', change['hash']).strip()
+        lines.append('{} {:040x}'.format(full_hash, i))
+    # Incomplete lines are skipped
+    lines.append('0123456789abcdef')
+    mirror.mkdir('.hg').join('git-mapfile').write('\n'.join(lines))
+
+    git.enhance_changes_information(change_list, str(mirror), False)
+
+    for i, change in enumerate(change_list):
+        assert change['hg_hash'] == '{:012x}'.format(i)
+
+
+def test_unknown_hash_within_update_interval(git_repo, tmpdir):
+    """Test fetching an unknown hash, right after the last update."""
+    clone_dir = tmpdir.join('clone')
+    subprocess.check_output(('git', 'clone', '-q', str(git_repo),
+                             str(clone_dir)))
+    vcs = Vcs.factory(str(clone_dir))
+    vcs._get_latest()
+
+    git = _VcsCmd('git', str(git_repo))
+    git.run('commit', '-q', '--allow-empty', '-m', 'Pushed just now')
+    new_hash = git.run('rev-parse', '--short', 'HEAD').strip().decode('utf-8')
+
+    changes = vcs.change_list('master', new_hash)
+
+    assert [change['message'] for change in changes] == ['Pushed just now']
+    vcs.close()
+
+
+def test_git_abbreviations_from_mapfile(tmpdir):
+    """Test abbreviating Git hashes, which are only known from a mapfile."""
+    ambiguous = '0123456789' + '0' * 30
+    unique = 'abcdef0123' + '0' * 30
+    mapped_hashes = sorted([ambiguous, '01234567' + 'f' * 32, unique])
+
+    abbreviations = Git._abbreviations({ambiguous, unique}, mapped_hashes,
+                                       str(tmpdir))
+
+    assert abbreviations == {ambiguous: '012345678', unique: 'abcdef0'}
+
+
+def test_directed_change_list(repo):
+    """Test listing changes for up- and downgrades."""
+    vcs = Vcs.factory(str(repo))
+    first_rev = PREVIOUS_REVISION[vcs.__class__]
+
+    changes, downgrade = vcs.directed_change_list(first_rev, 'master')
+    assert downgrade is False
+    assert changes == vcs.change_list(first_rev, 'master')
+
+    changes, downgrade = vcs.directed_change_list('master', first_rev)
+    assert downgrade is True
+    assert changes == vcs.change_list(first_rev, 'master')
+
+
+def test_update_for_revisions(repo, monkeypatch):
+    """Test updating the history only if a revision might have changed."""
+    vcs = Vcs.factory(str(repo))
+    latest = vcs._local_hash('master')
+    updates = []
+    monkeypatch.setattr(vcs, '_get_latest',
+                        lambda force=False: updates.append(force))
+
+    # Known hashes, a name and an unknown hash
+    vcs._get_latest_for(latest, latest[:vcs.SHORT_HASH_LENGTH])
+    vcs._get_latest_for(latest, 'master')
+    vcs._get_latest_for(latest, '0123456789ab')
+
+    assert updates == [False, True]
+    vcs.close()
+
 
-        repo.join('foobar.txt').write('foobar')
+def test_unthrottled_updates(repo):
+    """Test updating within the update interval, if not throttled."""
+    vcs = Vcs.factory(str(repo))
+    vcs._get_latest()
+    stamp = os.path.join(str(repo), vcs.VCS_REQUIREMENT, 'depup-updated')
+    last_update = time.time() - vcs.UPDATE_INTERVAL / 2
+    os.utime(stamp, (last_update, last_update))
 
-        vcs.commit_changes('Testing commit')
+    vcs._get_latest()
+    assert os.path.getmtime(stamp) == last_update
 
-        assert 'Testing commit' in vcs.run_cmd('log')
+    vcs.throttle_updates = False
+    vcs._get_latest()
+    assert os.path.getmtime(stamp) > last_update
+    vcs.close()